@@ -1,28 +1,49 @@
 import os
-import sys
 import json
 import asyncio
-import requests
-import time
-from typing import List, Dict, Any
+import hashlib
+import functools
+from typing import List, Dict, Any, Optional
 from dataclasses import dataclass
 from datetime import datetime, timezone
 from urllib.parse import urlparse
 from dotenv import load_dotenv
 
+import numpy as np
 from crawl4ai import AsyncWebCrawler, BrowserConfig, CrawlerRunConfig, CacheMode
 import google.generativeai as genai
-from sentence_transformers import SentenceTransformer
 from supabase import create_client, Client
 
+from onnx_embedding import load_embedding_model
+
 load_dotenv()
 
-# Initialize Gemini and Supabase clients
-genai.configure(api_key=os.getenv("GEMINI_API_KEY"))
-model = genai.GenerativeModel('gemini-2.0-flash-exp')
+TITLE_SUMMARY_SYSTEM_PROMPT = """You are an AI that extracts titles and summaries from medical facilities documentation chunks.
+Return a JSON object with 'title' and 'summary' keys.
+For the title: If this seems like the start of a document, extract its title. If it's a middle chunk, derive a descriptive title.
+For the summary: Create a concise summary of the main points in this chunk.
+Keep both title and summary concise but informative."""
+
+@functools.lru_cache(maxsize=1)
+def get_gemini_model():
+    """Get the Gemini model for title/summary extraction, configured once.
+
+    The system prompt is baked in and JSON output is requested, so each
+    call only sends the chunk itself. Lazy so importing this module (e.g.
+    just for the URL list) doesn't touch the Gemini API.
+    """
+    genai.configure(api_key=os.getenv("GEMINI_API_KEY"))
+    return genai.GenerativeModel(
+        'gemini-2.0-flash-exp',
+        system_instruction=TITLE_SUMMARY_SYSTEM_PROMPT,
+        generation_config={'response_mime_type': 'application/json'}
+    )
 
-# Initialize sentence transformer for embeddings
-embedding_model = SentenceTransformer('all-mpnet-base-v2')
+@functools.lru_cache(maxsize=1)
+def get_embedding_model():
+    """Get the embedding model (ONNX INT8 on CPU when available, otherwise
+    PyTorch with GPU + fp16 when a GPU is present), loaded on first use."""
+    return load_embedding_model()
 
 supabase: Client = create_client(
     os.getenv("SUPABASE_URL"),
@@ -37,7 +58,7 @@ class ProcessedChunk:
     summary: str
     content: str
     metadata: Dict[str, Any]
-    embedding: List[float]
+    embedding: np.ndarray  # float32, converted to a list only at insert time
 
 def chunk_text(text: str, chunk_size: int = 5000) -> List[str]:
     """Split text into chunks, respecting code blocks and paragraphs."""
@@ -54,25 +75,25 @@ def chunk_text(text: str, chunk_size: int = 5000) -> List[str]:
             chunks.append(text[start:].strip())
             break
 
+        # Search directly on the original string with bounded rfind so no
+        # intermediate substring is copied per iteration. Only consider
+        # breaks past 30% of chunk_size by starting the search there.
+        min_break = start + int(chunk_size * 0.3)
+
         # Try to find a code block boundary first (```)
-        chunk = text[start:end]
-        code_block = chunk.rfind('```')
-        if code_block != -1 and code_block > chunk_size * 0.3:
-            end = start + code_block
-
-        # If no code block, try to break at a paragraph
-        elif '\n\n' in chunk:
-            # Find the last paragraph break
-            last_break = chunk.rfind('\n\n')
-            if last_break > chunk_size * 0.3:  # Only break if we're past 30% of chunk_size
-                end = start + last_break
-
-        # If no paragraph break, try to break at a sentence
-        elif '. ' in chunk:
-            # Find the last sentence break
-            last_period = chunk.rfind('. ')
-            if last_period > chunk_size * 0.3:  # Only break if we're past 30% of chunk_size
-                end = start + last_period + 1
+        code_block = text.rfind('```', min_break, end)
+        if code_block != -1:
+            end = code_block
+        else:
+            # If no code block, try to break at a paragraph
+            last_break = text.rfind('\n\n', min_break, end)
+            if last_break != -1:
+                end = last_break
+            else:
+                # If no paragraph break, try to break at a sentence
+                last_period = text.rfind('. ', min_break, end)
+                if last_period != -1:
+                    end = last_period + 1
 
         # Extract chunk and clean it up
         chunk = text[start:end].strip()
@@ -84,25 +105,52 @@ def chunk_text(text: str, chunk_size: int = 5000) -> List[str]:
 
     return chunks
 
+def get_title_and_summary_local(chunk: str, url: str) -> Optional[Dict[str, str]]:
+    """Derive a title and summary from the chunk without calling Gemini.
+
+    Uses the first Markdown header as the title and the first two sentences
+    of the body text as the summary. Returns None when the chunk has no
+    header so the caller can fall back to Gemini.
+    """
+    title = None
+    for line in chunk.splitlines():
+        line = line.strip()
+        if line.startswith('#'):
+            title = line.lstrip('#').strip()
+            if title:
+                break
+
+    if not title:
+        return None
+
+    # Use the first two sentences of the body text as the summary
+    body = ' '.join(
+        line.strip() for line in chunk.splitlines()
+        if line.strip() and not line.strip().startswith('#')
+    )
+    sentences = body.split('. ')
+    summary = '. '.join(sentences[:2]).strip()
+    if summary and not summary.endswith('.'):
+        summary += '.'
+    if not summary:
+        summary = f"Content from {url} - {len(chunk)} characters"
+
+    return {"title": title, "summary": summary}
+
 async def get_title_and_summary_with_retry(chunk: str, url: str, max_retries: int = 3) -> Dict[str, str]:
     """Extract title and summary using Gemini 2.0 with rate limiting and retry logic."""
-    system_prompt = """You are an AI that extracts titles and summaries from medical facilities documentation chunks.
-    Return a JSON object with 'title' and 'summary' keys.
-    For the title: If this seems like the start of a document, extract its title. If it's a middle chunk, derive a descriptive title.
-    For the summary: Create a concise summary of the main points in this chunk.
-    Keep both title and summary concise but informative."""
-    
     for attempt in range(max_retries):
         try:
-            prompt = f"{system_prompt}\n\nURL: {url}\n\nContent:\n{chunk[:1000]}..."
-            
+            # Only the dynamic part; the system prompt lives on the model
+            prompt = f"URL: {url}\n\nContent:\n{chunk[:1000]}..."
+
             # Add delay between requests to avoid rate limiting
             if attempt > 0:
                 delay = min(2 ** attempt, 30)  # Exponential backoff, max 30 seconds
                 print(f"Rate limited, waiting {delay} seconds before retry {attempt + 1}/{max_retries}")
                 await asyncio.sleep(delay)
             
-            response = model.generate_content(prompt)
+            response = get_gemini_model().generate_content(prompt)
             
             # Try to parse JSON from response
             try:
@@ -133,29 +181,65 @@ async def get_title_and_summary_with_retry(chunk: str, url: str, max_retries: in
     
     return {"title": "Error processing title", "summary": "Error processing summary"}
 
-def get_embedding(text: str) -> List[float]:
-    """Get embedding vector using all-mpnet-base-v2."""
+def get_embeddings(texts: List[str]) -> np.ndarray:
+    """Get embedding vectors for a batch of texts using all-mpnet-base-v2.
+
+    Encoding all chunks in one call amortizes tokenization and forward-pass
+    overhead, which is much faster than encoding one chunk at a time.
+    Texts are encoded in length-sorted order so each minibatch only pads to
+    its own longest member instead of the global maximum, then results are
+    restored to the original order.
+    """
     try:
-        embedding = embedding_model.encode(text)
-        return embedding.tolist()
+        # Sort by length so similarly-sized texts share a minibatch
+        order = sorted(range(len(texts)), key=lambda i: len(texts[i]))
+        sorted_embeddings = get_embedding_model().encode(
+            [texts[i] for i in order],
+            batch_size=32,
+            convert_to_numpy=True,
+            convert_to_tensor=False,
+            show_progress_bar=False,
+            normalize_embeddings=True
+        )
+
+        # Unpermute back to the original chunk order
+        embeddings = np.empty_like(sorted_embeddings)
+        embeddings[order] = sorted_embeddings
+        return embeddings
     except Exception as e:
-        print(f"Error getting embedding: {e}")
-        return [0] * 768  # Return zero vector on error (mpnet-base-v2 has 768 dimensions)
+        print(f"Error getting embeddings: {e}")
+        return np.zeros((len(texts), 768), dtype=np.float32)  # Return zero vectors on error (mpnet-base-v2 has 768 dimensions)
 
-async def process_chunk(chunk: str, chunk_number: int, url: str) -> ProcessedChunk:
+def get_stored_content_hash(url: str) -> Optional[str]:
+    """Get the content hash stored with a URL's chunks, if any."""
+    try:
+        result = supabase.table("site_pages") \
+            .select("metadata->>content_hash") \
+            .eq("url", url) \
+            .limit(1) \
+            .execute()
+        if result.data:
+            return result.data[0].get("content_hash")
+        return None
+    except Exception as e:
+        print(f"Error checking stored content hash for {url}: {e}")
+        return None
+
+async def process_chunk(chunk: str, chunk_number: int, url: str, embedding: np.ndarray, content_hash: str) -> ProcessedChunk:
     """Process a single chunk of text."""
-    # Get title and summary with retry logic
-    extracted = await get_title_and_summary_with_retry(chunk, url)
-    
-    # Get embedding
-    embedding = get_embedding(chunk)
-    
+    # Derive title and summary locally; only call Gemini when the chunk
+    # has no header to work from
+    extracted = get_title_and_summary_local(chunk, url)
+    if extracted is None:
+        extracted = await get_title_and_summary_with_retry(chunk, url)
+
     # Create metadata
     metadata = {
         "source": "stanford_medical_facilities",
         "chunk_size": len(chunk),
         "crawled_at": datetime.now(timezone.utc).isoformat(),
-        "url_path": urlparse(url).path
+        "url_path": urlparse(url).path,
+        "content_hash": content_hash
     }
     
     return ProcessedChunk(
@@ -168,49 +252,96 @@ async def process_chunk(chunk: str, chunk_number: int, url: str) -> ProcessedChu
         embedding=embedding
     )
 
-async def insert_chunk(chunk: ProcessedChunk):
-    """Insert a processed chunk into Supabase."""
+def chunk_to_row(chunk: ProcessedChunk) -> Dict[str, Any]:
+    """Convert a processed chunk into a Supabase row dict."""
+    return {
+        "url": chunk.url,
+        "chunk_number": chunk.chunk_number,
+        "title": chunk.title,
+        "summary": chunk.summary,
+        "content": chunk.content,
+        "metadata": chunk.metadata,
+        "embedding": chunk.embedding.tolist()  # Python floats only at the client boundary
+    }
+
+async def insert_chunks(chunks: List[ProcessedChunk]):
+    """Insert processed chunks into Supabase in a single bulk request.
+
+    The supabase-py client is synchronous, so the insert runs in a thread
+    to keep the event loop free. Falls back to per-row inserts if the bulk
+    insert fails, so one bad row doesn't lose the whole document.
+    """
+    if not chunks:
+        return None
+
+    rows = [chunk_to_row(chunk) for chunk in chunks]
     try:
-        data = {
-            "url": chunk.url,
-            "chunk_number": chunk.chunk_number,
-            "title": chunk.title,
-            "summary": chunk.summary,
-            "content": chunk.content,
-            "metadata": chunk.metadata,
-            "embedding": chunk.embedding
-        }
-        
-        result = supabase.table("site_pages").insert(data).execute()
-        print(f"Inserted chunk {chunk.chunk_number} for {chunk.url}")
+        result = await asyncio.to_thread(
+            lambda: supabase.table("site_pages").insert(rows).execute()
+        )
+        print(f"Inserted {len(rows)} chunks for {chunks[0].url}")
         return result
     except Exception as e:
-        print(f"Error inserting chunk: {e}")
+        print(f"Error bulk inserting chunks, retrying per row: {e}")
+        for chunk, row in zip(chunks, rows):
+            try:
+                await asyncio.to_thread(
+                    lambda row=row: supabase.table("site_pages").insert(row).execute()
+                )
+                print(f"Inserted chunk {chunk.chunk_number} for {chunk.url}")
+            except Exception as row_error:
+                print(f"Error inserting chunk {chunk.chunk_number}: {row_error}")
         return None
 
 async def process_and_store_document(url: str, markdown: str):
-    """Process a document and store its chunks with rate limiting."""
+    """Process a document and store its chunks with bounded concurrency.
+
+    Skips the document entirely when its content hash matches what is
+    already stored, so re-runs don't re-pay the Gemini and embedding cost
+    for unchanged pages.
+    """
+    content_hash = hashlib.sha256(markdown.encode()).hexdigest()
+    stored_hash = await asyncio.to_thread(get_stored_content_hash, url)
+    if stored_hash == content_hash:
+        print(f"Skipping {url}: content unchanged")
+        return
+
+    # Remove any previous rows for this URL before re-inserting
+    await asyncio.to_thread(
+        lambda: supabase.table("site_pages").delete().eq("url", url).execute()
+    )
+
     # Split into chunks
     chunks = chunk_text(markdown)
-    
+
     print(f"Processing {len(chunks)} chunks for {url}")
-    
-    # Process chunks with rate limiting
-    for i, chunk in enumerate(chunks):
-        try:
-            # Process chunk
-            processed_chunk = await process_chunk(chunk, i, url)
-            
-            # Insert chunk
-            await insert_chunk(processed_chunk)
-            
-            # Add delay between chunks to avoid overwhelming the API
-            if i < len(chunks) - 1:  # Don't delay after the last chunk
-                await asyncio.sleep(1)  # 1 second delay between chunks
-                
-        except Exception as e:
-            print(f"Error processing chunk {i} for {url}: {e}")
-            continue
+
+    # Embed all chunks in one batched call; run it in a thread so the
+    # blocking encode doesn't stall the event loop
+    embeddings = await asyncio.to_thread(get_embeddings, chunks)
+
+    # Process chunks in parallel; the semaphore keeps the Gemini
+    # title/summary calls within the API rate limit
+    semaphore = asyncio.Semaphore(4)
+
+    async def process_with_limit(chunk: str, i: int) -> ProcessedChunk:
+        async with semaphore:
+            return await process_chunk(chunk, i, url, embeddings[i], content_hash)
+
+    results = await asyncio.gather(
+        *(process_with_limit(chunk, i) for i, chunk in enumerate(chunks)),
+        return_exceptions=True
+    )
+
+    processed_chunks = []
+    for i, result in enumerate(results):
+        if isinstance(result, Exception):
+            print(f"Error processing chunk {i} for {url}: {result}")
+        else:
+            processed_chunks.append(result)
+
+    # Insert all processed chunks in one round-trip
+    await insert_chunks(processed_chunks)
 
 async def crawl_parallel(urls: List[str], max_concurrent: int = 2):
     """Crawl multiple URLs in parallel with a concurrency limit and rate limiting."""
@@ -0,0 +1,101 @@
+"""ONNX Runtime embedding backend for CPU-only deployments.
+
+PyTorch inference leaves 2-5x on the table on CPU-only hosts. Export the
+model once with:
+
+    optimum-cli export onnx --model sentence-transformers/all-mpnet-base-v2 \
+        --task feature-extraction mpnet_onnx/
+
+and optionally dynamic-quantize it to INT8 with
+optimum.onnxruntime.ORTQuantizer for a further speedup. Point
+EMBEDDING_ONNX_PATH at the export directory (default: mpnet_onnx). The
+optimum[onnxruntime] extra is an optional dependency; when it or the
+export directory is missing, load_embedding_model falls back to the
+regular SentenceTransformer.
+"""
+import os
+from typing import List, Union
+
+import numpy as np
+
+ONNX_MODEL_DIR = os.getenv("EMBEDDING_ONNX_PATH", "mpnet_onnx")
+
+class OnnxEmbeddingModel:
+    """all-mpnet-base-v2 via ONNX Runtime, with a SentenceTransformer-style
+    encode() so it can drop in wherever the PyTorch model is used."""
+
+    def __init__(self, model_dir: str):
+        from optimum.onnxruntime import ORTModelForFeatureExtraction
+        from transformers import AutoTokenizer
+
+        file_name = os.getenv("EMBEDDING_ONNX_FILE")  # e.g. model_quantized.onnx
+        self.model = ORTModelForFeatureExtraction.from_pretrained(
+            model_dir,
+            file_name=file_name,
+            provider="CPUExecutionProvider"
+        )
+        self.tokenizer = AutoTokenizer.from_pretrained(model_dir)
+
+    def encode(
+        self,
+        sentences: Union[str, List[str]],
+        batch_size: int = 32,
+        convert_to_numpy: bool = True,
+        convert_to_tensor: bool = False,
+        show_progress_bar: bool = False,
+        normalize_embeddings: bool = False
+    ) -> np.ndarray:
+        """Embed text(s) with tokenize + forward + mean pooling, replicating
+        SentenceTransformer's output for all-mpnet-base-v2."""
+        single = isinstance(sentences, str)
+        texts = [sentences] if single else list(sentences)
+
+        batches = []
+        for i in range(0, len(texts), batch_size):
+            inputs = self.tokenizer(
+                texts[i:i + batch_size],
+                padding=True,
+                truncation=True,
+                max_length=384,
+                return_tensors="pt"
+            )
+            outputs = self.model(**inputs)
+            hidden = outputs.last_hidden_state.cpu().numpy()
+
+            # Mean pooling over non-padding tokens
+            mask = inputs["attention_mask"].cpu().numpy()[:, :, None].astype(np.float32)
+            summed = (hidden * mask).sum(axis=1)
+            counts = np.clip(mask.sum(axis=1), 1e-9, None)
+            batches.append(summed / counts)
+
+        embeddings = np.concatenate(batches, axis=0).astype(np.float32)
+        if normalize_embeddings:
+            norms = np.linalg.norm(embeddings, axis=1, keepdims=True)
+            norms[norms == 0] = 1.0
+            embeddings /= norms
+
+        return embeddings[0] if single else embeddings
+
+def load_embedding_model():
+    """Load the embedding model, preferring the ONNX backend on CPU.
+
+    Uses the exported (and typically INT8-quantized) ONNX model when the
+    export directory and optimum are available; otherwise falls back to the
+    PyTorch SentenceTransformer on GPU with fp16 when a GPU is present.
+    """
+    if os.path.isdir(ONNX_MODEL_DIR):
+        try:
+            model = OnnxEmbeddingModel(ONNX_MODEL_DIR)
+            print(f"Loaded ONNX embedding model from {ONNX_MODEL_DIR}")
+            return model
+        except Exception as e:
+            print(f"Error loading ONNX embedding model, falling back to PyTorch: {e}")
+
+    import torch
+    from sentence_transformers import SentenceTransformer
+
+    device = "cuda" if torch.cuda.is_available() else "cpu"
+    model = SentenceTransformer('all-mpnet-base-v2', device=device)
+    if device == "cuda":
+        model.half()
+    return model
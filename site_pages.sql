@@ -69,4 +69,17 @@ create policy "Allow public read access"
   on site_pages
   for select
   to public
-  using (true); 
\ No newline at end of file
+  using (true); 
+-- Covering index so the distinct-URL listing below is index-only
+create index idx_site_pages_source_url on site_pages ((metadata->>'source'), url);
+
+-- Create a function to list the distinct Stanford Medical Facilities URLs
+-- server-side instead of transferring every chunk row to the client
+create function list_stanford_urls () returns table (url varchar)
+language sql
+as $$
+  select distinct url
+  from site_pages
+  where metadata->>'source' = 'stanford_medical_facilities'
+  order by url;
+$$;
@@ -1,20 +1,59 @@
 import os
 import json
-import asyncio
-from typing import List, Dict, Any
+import time
+import datetime
+import functools
+import threading
+from typing import List, Dict
 from dotenv import load_dotenv
+import numpy as np
 import google.generativeai as genai
-from sentence_transformers import SentenceTransformer
 from supabase import Client
 
+from onnx_embedding import load_embedding_model
+
+try:
+    import faiss
+except ImportError:
+    faiss = None
+
 load_dotenv()
 
 # Initialize Gemini
 genai.configure(api_key=os.getenv("GEMINI_API_KEY"))
-model = genai.GenerativeModel('gemini-2.0-flash')
 
-# Initialize sentence transformer for embeddings
-embedding_model = SentenceTransformer('all-mpnet-base-v2')
+SYSTEM_PROMPT = """You are a helpful and knowledgeable assistant for Stanford Medical Facilities. You have access to comprehensive documentation about Stanford's medical facilities, including emergency management, safety guidelines, facility information, projects, space planning, and locations.
+
+Your role is to:
+1. Provide helpful, conversational responses based on the available documentation
+2. Be specific and detailed when possible
+3. If you find relevant information, mention the source URLs
+4. If you don't have enough information, suggest where users can find more details
+5. Always be friendly and professional
+6. Format your response properly"""
+
+# Gemini context cache: the system prompt and the available pages list are
+# a stable prefix, so they are uploaded once and referenced by the cache
+# instead of being re-sent as fresh tokens on every call
+CONTEXT_CACHE_TTL_MINUTES = 30
+_chat_model = None
+_chat_model_expiry = 0.0
+
+# Embedding model singleton; loaded lazily so importing this module stays
+# cheap, and lock-protected so concurrent first calls don't load two
+# ~420MB copies of the weights
+_embedding_model = None
+_embedding_model_lock = threading.Lock()
+
+def get_embedding_model():
+    """Get the shared all-mpnet-base-v2 model (ONNX INT8 on CPU when
+    available, otherwise PyTorch with GPU + fp16 when a GPU is present)."""
+    global _embedding_model
+    if _embedding_model is None:
+        with _embedding_model_lock:
+            if _embedding_model is None:
+                _embedding_model = load_embedding_model()
+    return _embedding_model
 
 # Initialize Supabase
 supabase: Client = Client(
@@ -22,38 +61,151 @@ supabase: Client = Client(
     os.getenv("SUPABASE_SERVICE_KEY")
 )
 
-def get_embedding(text: str) -> List[float]:
-    """Get embedding vector using all-mpnet-base-v2."""
+# In-memory retrieval index: a FAISS HNSW graph when faiss is installed
+# (log-N search, scales with the corpus), otherwise a symmetric-int8 matrix
+# scored with one numpy matmul. Either way retrieval skips the Postgres
+# round-trip. The index is rebuilt when it goes stale.
+CORPUS_REFRESH_SECONDS = 600
+FAISS_HNSW_NEIGHBORS = 32
+_corpus_lock = threading.Lock()
+_corpus_rows: List[Dict] = []
+_corpus_matrix = np.zeros((0, 768), dtype=np.int8)
+_corpus_index = None
+_corpus_loaded_at = 0.0
+
+def quantize_int8(values: np.ndarray) -> np.ndarray:
+    """Symmetric int8 quantization with a single per-tensor scale.
+
+    A uniform positive scale leaves the dot-product ranking unchanged, so
+    the quantized scores sort candidates the same way the float ones do.
+    """
+    scale = np.abs(values).max()
+    if scale == 0:
+        return values.astype(np.int8)
+    return np.clip(np.round(values * (127.0 / scale)), -127, 127).astype(np.int8)
+
+def _load_corpus() -> tuple[List[Dict], np.ndarray]:
+    """Load all chunk rows and their embeddings, L2-normalized, into memory."""
+    result = supabase.from_('site_pages') \
+        .select('id, url, title, content, embedding') \
+        .eq('metadata->>source', 'stanford_medical_facilities') \
+        .execute()
+
+    rows = result.data or []
+    if not rows:
+        return [], np.zeros((0, 768), dtype=np.float32)
+
+    embeddings = []
+    for row in rows:
+        embedding = row['embedding']
+        if isinstance(embedding, str):
+            # pgvector columns come back as '[0.1,0.2,...]' strings
+            embedding = json.loads(embedding)
+        embeddings.append(embedding)
+
+    matrix = np.asarray(embeddings, dtype=np.float32)
+    norms = np.linalg.norm(matrix, axis=1, keepdims=True)
+    norms[norms == 0] = 1.0
+    matrix /= norms
+    return rows, matrix
+
+def get_corpus():
+    """Get the cached (rows, matrix, index) corpus, refreshing it when stale."""
+    global _corpus_rows, _corpus_matrix, _corpus_index, _corpus_loaded_at
+    now = time.time()
+    if _corpus_rows and now - _corpus_loaded_at < CORPUS_REFRESH_SECONDS:
+        return _corpus_rows, _corpus_matrix, _corpus_index
+
+    with _corpus_lock:
+        if not _corpus_rows or now - _corpus_loaded_at >= CORPUS_REFRESH_SECONDS:
+            rows, matrix = _load_corpus()
+            if faiss is not None and len(rows) > 0:
+                # Embeddings are normalized, so inner product == cosine
+                index = faiss.IndexHNSWFlat(768, FAISS_HNSW_NEIGHBORS, faiss.METRIC_INNER_PRODUCT)
+                index.add(matrix)
+                _corpus_index = index
+                _corpus_matrix = np.zeros((0, 768), dtype=np.int8)
+            else:
+                _corpus_index = None
+                _corpus_matrix = quantize_int8(matrix)
+            _corpus_rows = rows
+            _corpus_loaded_at = now
+    return _corpus_rows, _corpus_matrix, _corpus_index
+
+def search_corpus(query_embedding: np.ndarray, match_count: int = 8) -> List[Dict]:
+    """Find the chunks closest to the query in the in-memory corpus."""
+    rows, matrix, index = get_corpus()
+    if not rows:
+        return []
+
+    k = min(match_count, len(rows))
+    if index is not None:
+        _, neighbors = index.search(query_embedding[None, :].astype(np.float32), k)
+        return [rows[i] for i in neighbors[0] if i >= 0]
+
+    # int32 accumulation avoids overflow of the int8 products
+    query_q = quantize_int8(query_embedding).astype(np.int32)
+    scores = matrix.astype(np.int32) @ query_q
+    top = np.argpartition(-scores, k - 1)[:k]
+    return [rows[i] for i in top[np.argsort(-scores[top])]]
+
+# Semantic cache for retrieval results: repeated or near-identical queries
+# skip both the encode and the Supabase round-trip
+SEMANTIC_CACHE_THRESHOLD = 0.92
+SEMANTIC_CACHE_MAX_SIZE = 128
+_semantic_cache_matrix = np.zeros((0, 768), dtype=np.float32)
+_semantic_cache_results: List[tuple] = []
+
+@functools.lru_cache(maxsize=512)
+def _encode_query(text: str) -> np.ndarray:
+    """Encode a query text, caching exact repeats."""
+    return get_embedding_model().encode(text, normalize_embeddings=True)
+
+def get_embedding(text: str) -> np.ndarray:
+    """Get embedding vector using all-mpnet-base-v2 as a float32 array."""
     try:
-        embedding = embedding_model.encode(text)
-        return embedding.tolist()
+        return np.asarray(_encode_query(text.strip()), dtype=np.float32)
     except Exception as e:
         print(f"Error getting embedding: {e}")
-        return [0] * 768
+        return np.zeros(768, dtype=np.float32)
 
 async def retrieve_relevant_documentation(user_query: str) -> tuple[str, List[Dict]]:
     """Retrieve relevant documentation chunks based on the query with RAG."""
+    global _semantic_cache_matrix
     try:
         # Get the embedding for the query
         query_embedding = get_embedding(user_query)
-        
-        # Query Supabase for relevant documents
-        result = supabase.rpc(
-            'match_site_pages',
-            {
-                'query_embedding': query_embedding,
-                'match_count': 8,  # Increased to get more context
-                'filter': {'source': 'stanford_medical_facilities'}
-            }
-        ).execute()
-        
-        if not result.data:
+
+        # Check the semantic cache for a near-identical earlier query
+        if len(_semantic_cache_results) > 0:
+            scores = _semantic_cache_matrix @ query_embedding
+            best = int(np.argmax(scores))
+            if scores[best] > SEMANTIC_CACHE_THRESHOLD:
+                return _semantic_cache_results[best]
+
+        # Search the in-memory corpus; fall back to the Supabase RPC if
+        # the corpus cannot be loaded
+        try:
+            matched = search_corpus(query_embedding, match_count=8)  # Increased to get more context
+        except Exception as e:
+            print(f"Error searching in-memory corpus, falling back to RPC: {e}")
+            result = supabase.rpc(
+                'match_site_pages',
+                {
+                    'query_embedding': query_embedding.tolist(),
+                    'match_count': 8,
+                    'filter': {'source': 'stanford_medical_facilities'}
+                }
+            ).execute()
+            matched = result.data or []
+
+        if not matched:
             return "No relevant documentation found.", []
-            
+
         # Format the results and collect URLs
         formatted_chunks = []
         urls = []
-        for doc in result.data:
+        for doc in matched:
             chunk_text = f"""
 # {doc['title']}
 
@@ -64,8 +216,17 @@ async def retrieve_relevant_documentation(user_query: str) -> tuple[str, List[Di
                 urls.append(doc['url'])
             
         # Join all chunks with a separator
-        return "\n\n---\n\n".join(formatted_chunks), urls
-        
+        docs = "\n\n---\n\n".join(formatted_chunks)
+
+        # Remember this query so near-duplicates can be served from memory
+        if len(_semantic_cache_results) >= SEMANTIC_CACHE_MAX_SIZE:
+            _semantic_cache_results.pop(0)
+            _semantic_cache_matrix = _semantic_cache_matrix[1:]
+        _semantic_cache_matrix = np.vstack([_semantic_cache_matrix, query_embedding[None, :]])
+        _semantic_cache_results.append((docs, urls))
+
+        return docs, urls
+
     except Exception as e:
         print(f"Error retrieving documentation: {e}")
         return f"Error retrieving documentation: {str(e)}", []
@@ -73,19 +234,31 @@ async def retrieve_relevant_documentation(user_query: str) -> tuple[str, List[Di
 async def list_documentation_pages() -> List[str]:
     """Retrieve a list of all available Stanford Medical Facilities documentation pages."""
     try:
-        # Query Supabase for unique URLs where source is stanford_medical_facilities
+        # Let Postgres dedupe the URLs so only distinct pages cross the wire
+        result = supabase.rpc('list_stanford_urls').execute()
+
+        if not result.data:
+            return []
+
+        return [doc['url'] for doc in result.data]
+
+    except Exception as e:
+        print(f"Error listing URLs via RPC, falling back to client-side dedup: {e}")
+
+    try:
+        # Fallback: query all chunk rows and dedupe client-side
         result = supabase.from_('site_pages') \
             .select('url') \
             .eq('metadata->>source', 'stanford_medical_facilities') \
             .execute()
-        
+
         if not result.data:
             return []
-            
+
         # Extract unique URLs
         urls = sorted(set(doc['url'] for doc in result.data))
         return urls
-        
+
     except Exception as e:
         print(f"Error retrieving documentation pages: {e}")
         return []
@@ -119,29 +292,49 @@ async def get_page_content(url: str) -> str:
         print(f"Error retrieving page content: {e}")
         return f"Error retrieving page content: {str(e)}"
 
-async def generate_response(user_query: str) -> str:
-    """Generate a response using Gemini with RAG."""
+async def get_chat_model():
+    """Get the Gemini chat model, backed by an explicit context cache.
+
+    The system prompt and available pages list are uploaded to a Gemini
+    context cache once per TTL window, so each call only pays for the
+    dynamic part of the prompt. Falls back to an uncached model if the
+    cache cannot be created (e.g. the prefix is below the minimum size).
+    """
+    global _chat_model, _chat_model_expiry
+    now = time.time()
+    if _chat_model is not None and now < _chat_model_expiry:
+        return _chat_model
+
+    available_pages = await list_documentation_pages()
     try:
-        # First, retrieve relevant documentation
-        relevant_docs, source_urls = await retrieve_relevant_documentation(user_query)
-        
-        # Get list of available pages
-        available_pages = await list_documentation_pages()
-        
-        # Create the prompt for Gemini
-        system_prompt = """You are a helpful and knowledgeable assistant for Stanford Medical Facilities. You have access to comprehensive documentation about Stanford's medical facilities, including emergency management, safety guidelines, facility information, projects, space planning, and locations.
+        cached_content = genai.caching.CachedContent.create(
+            model='models/gemini-2.0-flash',
+            system_instruction=SYSTEM_PROMPT,
+            contents=[f"Available documentation pages: {available_pages}"],
+            ttl=datetime.timedelta(minutes=CONTEXT_CACHE_TTL_MINUTES)
+        )
+        _chat_model = genai.GenerativeModel.from_cached_content(cached_content)
+        # Refresh slightly before the server-side cache expires
+        _chat_model_expiry = now + (CONTEXT_CACHE_TTL_MINUTES - 1) * 60
+    except Exception as e:
+        print(f"Error creating Gemini context cache, using uncached model: {e}")
+        _chat_model = genai.GenerativeModel(
+            'gemini-2.0-flash',
+            system_instruction=f"{SYSTEM_PROMPT}\n\nAvailable documentation pages: {available_pages}"
+        )
+        _chat_model_expiry = now + 5 * 60
 
-Your role is to:
-1. Provide helpful, conversational responses based on the available documentation
-2. Be specific and detailed when possible
-3. If you find relevant information, mention the source URLs
-4. If you don't have enough information, suggest where users can find more details
-5. Always be friendly and professional
-6. Format your response properly
+    return _chat_model
 
-Available documentation pages: {available_pages}
+async def generate_response_stream(user_query: str):
+    """Generate a response using Gemini with RAG, yielding text as it arrives."""
+    try:
+        # First, retrieve relevant documentation
+        relevant_docs, source_urls = await retrieve_relevant_documentation(user_query)
 
-Relevant documentation chunks:
+        # Only the dynamic part of the prompt; the system prompt and pages
+        # list are served from the context cache
+        prompt = f"""Relevant documentation chunks:
 {relevant_docs}
 
 Source URLs: {source_urls}
@@ -149,54 +342,51 @@ Source URLs: {source_urls}
 User question: {user_query}
 
 Please provide a helpful, conversational response. If you reference information from the documentation, mention the relevant URLs. If you don't have complete information, suggest checking the specific pages for more details."""
-        
-        # Generate response using Gemini
-        response = model.generate_content(system_prompt.format(
-            available_pages=available_pages,
-            relevant_docs=relevant_docs,
-            source_urls=source_urls,
-            user_query=user_query
-        ))
-        
-        return response.text
-        
+
+        # Stream the response from Gemini as it is generated
+        chat_model = await get_chat_model()
+        response = await chat_model.generate_content_async(prompt, stream=True)
+
+        async for chunk in response:
+            if chunk.text:
+                yield chunk.text
+
     except Exception as e:
         print(f"Error generating response: {e}")
-        return f"I apologize, but I encountered an error: {str(e)}"
+        yield f"I apologize, but I encountered an error: {str(e)}"
 
 # For compatibility with the existing Streamlit UI
 class StanfordMedicalFacilitiesDeps:
     def __init__(self):
         self.supabase = supabase
-        self.embedding_model = embedding_model
+
+    @property
+    def embedding_model(self):
+        return get_embedding_model()
 
 class StreamResult:
-    """Result class that provides streaming functionality."""
-    
-    def __init__(self, response_text: str):
-        self.response_text = response_text
-    
+    """Result class that streams Gemini output as it is generated."""
+
+    def __init__(self, stream):
+        self._stream = stream
+
     async def stream_text(self, delta=True):
-        """Stream the response text character by character."""
-        for char in self.response_text:
-            yield char
-            await asyncio.sleep(0.01)  # Small delay for streaming effect
-    
+        """Yield response text chunks as Gemini produces them."""
+        async for text in self._stream:
+            yield text
+
     def new_messages(self):
         return []
 
 class StanfordMedicalFacilitiesExpert:
     """Simple expert class that mimics the pydantic-ai Agent interface."""
-    
+
     def __init__(self):
         self.deps = StanfordMedicalFacilitiesDeps()
-    
+
     async def run_stream(self, user_input: str, deps=None, message_history=None):
         """Run the expert with streaming response."""
-        # Generate response
-        response_text = await generate_response(user_input)
-        
-        return StreamResult(response_text)
+        return StreamResult(generate_response_stream(user_input))
 
 # Create the expert instance
 stanford_medical_facilities_expert = StanfordMedicalFacilitiesExpert() 
\ No newline at end of file
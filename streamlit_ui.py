@@ -1,47 +1,26 @@
-from __future__ import annotations
-from typing import Literal, TypedDict
 import asyncio
-import os
-import time
 
 import streamlit as st
-import json
-from supabase import Client
-from sentence_transformers import SentenceTransformer
 
-# Import our simplified expert
-from stanford_medical_facilities_expert import stanford_medical_facilities_expert, StanfordMedicalFacilitiesDeps
+# Import our simplified expert; it owns the embedding model and the
+# Supabase client, so no duplicate copies are loaded here
+from stanford_medical_facilities_expert import stanford_medical_facilities_expert
 
 # Load environment variables
 from dotenv import load_dotenv
 load_dotenv()
 
-# Initialize embedding model
-embedding_model = SentenceTransformer('all-mpnet-base-v2')
-
-supabase: Client = Client(
-    os.getenv("SUPABASE_URL"),
-    os.getenv("SUPABASE_SERVICE_KEY")
-)
-
-class ChatMessage(TypedDict):
-    """Format of messages sent to the browser/API."""
-
-    role: Literal['user', 'model']
-    timestamp: str
-    content: str
-
-async def run_agent_with_streaming(user_input: str, container=None):
+async def run_agent_with_streaming(user_input: str, container=None, loading_placeholder=None):
     """
     Run the agent with streaming text for the user_input prompt.
     Returns the complete response text for session state storage.
     """
     # Run the agent and get the result
     result = await stanford_medical_facilities_expert.run_stream(user_input)
-    
+
     # We'll gather partial text to show incrementally
     partial_text = ""
-    
+
     # Use provided container or create a new placeholder
     if container:
         message_placeholder = container.empty()
@@ -50,9 +29,13 @@ async def run_agent_with_streaming(user_input: str, container=None):
 
     # Render partial text as it arrives
     async for chunk in result.stream_text(delta=True):
+        # Clear the loading animation as soon as the first token lands
+        if loading_placeholder is not None:
+            loading_placeholder.empty()
+            loading_placeholder = None
         partial_text += chunk
         message_placeholder.markdown(partial_text)
-    
+
     # Return the complete response text
     return partial_text
 
@@ -233,15 +216,10 @@ async def main():
             </div>
         </div>
         """, unsafe_allow_html=True)
-        
-        # Brief pause to show the loading state
-        await asyncio.sleep(2.0)
-        
-        # Clear the loading animation
-        loading_placeholder.empty()
-        
-        # Run the agent once and capture the streaming response
-        response_text = await run_agent_with_streaming(user_input, assistant_container)
+
+        # Run the agent immediately; the loading animation stays visible
+        # only until the first token arrives
+        response_text = await run_agent_with_streaming(user_input, assistant_container, loading_placeholder)
         
         # Add assistant message to history
         st.session_state.messages.append({